@@ -4,6 +4,23 @@ from typing import Tuple
 
 class Tranceform3D2D:
     """3D座標を2D座標に変換するクラス"""
+
+    __slots__ = ('_fx', '_fy', '_cx', '_cy', '_R', '_t', '_angles', '_translation', '_P_T', '_P_t', '_p', '_buffer')
+
+    # カメラの後方や奥行きがほぼ0の点は投影できないため、画面外の座標を返す
+    _MIN_DEPTH = 1e-9
+    _OFFSCREEN = (-10000, -10000)
+    # 線分を切り取るニアクリップ面の奥行き
+    _NEAR = 1.0
+    # int32 へ変換する前に画像座標を収める範囲（OpenCVの描画関数がはみ出し分を切り取れる大きさ）
+    _COORD_LIMIT = 2 ** 30
+    # 視錐台の判定で画像の外側に余分に含める幅（画素）。線の太さと整数への切り捨て分を見込む
+    _CULL_MARGIN = 4
+    # 初期姿勢の回転行列と並進ベクトル（全インスタンスで共有するため書き込み不可にする）
+    _IDENTITY = np.eye(3)
+    _IDENTITY.setflags(write=False)
+    _ZERO = np.zeros(3)
+    _ZERO.setflags(write=False)
     
     def __init__(self, fx: float, fy: float, cx: float, cy: float):
         """
@@ -16,8 +33,12 @@ class Tranceform3D2D:
         """
         self._fx, self._fy = fx, fy
         self._cx, self._cy = cx, cy
-        self._R = np.eye(3)
-        self._t = np.zeros(3)
+        self._R = self._IDENTITY
+        self._t = self._ZERO
+        self._angles = (0.0, 0.0, 0.0)
+        self._translation = (0.0, 0.0, 0.0)
+        self._buffer = np.empty((0, 2))
+        self._update_cache()
 
     def set_external_parameter(self, roll: float, pitch: float, yaw: float, tx: float, ty: float, tz: float):
         """
@@ -30,32 +51,81 @@ class Tranceform3D2D:
         :param ty: y軸の並進
         :param tz: z軸の並進
         """
-        # 回転行列の計算
-        Rx = self._rotation_matrix(roll, 0)
-        Ry = self._rotation_matrix(pitch, 1)
-        Rz = self._rotation_matrix(yaw, 2)
-        self._R = Rz @ Ry @ Rx
-        self._t = np.array([tx, ty, tz])
+        # 回転が前回と同じなら、並進部分だけを計算し直す
+        if (roll, pitch, yaw) == self._angles:
+            self.set_translation(tx, ty, tz)
+            return
+        self._t = np.array([tx, ty, tz], dtype=np.float64)
+        self._translation = (tx, ty, tz)
+        self.set_rotation(roll, pitch, yaw)
+
+    def set_rotation(self, roll: float, pitch: float, yaw: float):
+        """
+        外部パラメータのうち回転だけを設定する
+        
+        :param roll: ロール角（度）
+        :param pitch: ピッチ角（度）
+        :param yaw: ヨー角（度）
+        """
+        angles = (roll, pitch, yaw)
+        if angles == self._angles:
+            return
+        self._R = self._rotation_from_angles(roll, pitch, yaw)
+        self._angles = angles
+        self._update_cache()
+
+    def set_translation(self, tx: float, ty: float, tz: float):
+        """
+        外部パラメータのうち並進だけを設定する
+        
+        回転は変わらないため、三角関数や行列積は行わず投影行列の並進部分だけを計算し直す
+        
+        :param tx: x軸の並進
+        :param ty: y軸の並進
+        :param tz: z軸の並進
+        """
+        translation = (tx, ty, tz)
+        if translation == self._translation:
+            return
+        self._t = np.array(translation, dtype=np.float64)
+        self._translation = translation
+        self._P_t = self._t * (self._fx, self._fy, 1.0)
+        self._p = tuple(row[:3] + (t,) for row, t in zip(self._p, self._P_t.tolist()))
 
     @staticmethod
-    def _rotation_matrix(angle: float, axis: int) -> np.ndarray:
+    def _rotation_from_angles(roll: float, pitch: float, yaw: float) -> np.ndarray:
         """
-        回転行列を生成する
+        ロール・ピッチ・ヨーから回転行列 Rz @ Ry @ Rx を生成する
         
-        :param angle: 回転角（度）
-        :param axis: 回転軸（0: x, 1: y, 2: z）
+        :param roll: ロール角（度）
+        :param pitch: ピッチ角（度）
+        :param yaw: ヨー角（度）
         :return: 回転行列
         """
-        rad = math.radians(angle)
-        c, s = math.cos(rad), math.sin(rad)
-        if axis == 0:  # X axis
-            return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
-        elif axis == 1:  # Y axis
-            return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
-        elif axis == 2:  # Z axis
-            return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
-        else:
-            raise ValueError("Invalid axis. Must be 0, 1, or 2.")
+        # 展開した式で直接求め、中間の行列と行列積を作らない
+        c_r, s_r = math.cos(math.radians(roll)), math.sin(math.radians(roll))
+        c_p, s_p = math.cos(math.radians(pitch)), math.sin(math.radians(pitch))
+        c_y, s_y = math.cos(math.radians(yaw)), math.sin(math.radians(yaw))
+        return np.array([
+            [c_y * c_p, c_y * s_p * s_r - s_y * c_r, c_y * s_p * c_r + s_y * s_r],
+            [s_y * c_p, s_y * s_p * s_r + c_y * c_r, s_y * s_p * c_r - c_y * s_r],
+            [-s_p, c_p * s_r, c_p * c_r],
+        ])
+
+    def _update_cache(self):
+        """
+        投影に使う値を外部パラメータの変更時にまとめて計算しておく
+
+        焦点距離と外部パラメータ [R|t] を3x4の投影行列 K[R|t] にまとめ、
+        一括変換用に転置済みの3x3部分と並進部分を連続メモリで、1点ごとの変換用に
+        各要素をPythonのfloatとして保持する。
+        主点 (cx, cy) は除算後に加える（行列に含めると主点上の点が丸め誤差で1画素ずれる）
+        """
+        K = np.diag([self._fx, self._fy, 1.0])
+        P = K @ np.concatenate([self._R, self._t.reshape(3, 1)], axis=1)
+        self._P_T = np.ascontiguousarray(P[:, :3].T)
+        self._P_t = P[:, 3].copy()
+        self._p = tuple(tuple(row) for row in P.tolist())
 
     def cvt_3d_to_2d(self, x: float, y: float, z: float) -> Tuple[int, int]:
         """
@@ -64,10 +134,167 @@ class Tranceform3D2D:
         :param x: 3D空間のx座標
         :param y: 3D空間のy座標
         :param z: 3D空間のz座標
-        :return: 2D画像上の(x, y)座標
+        :return: 2D画像上の(x, y)座標（カメラの後方の点は画面外の座標）
+        """
+        x_2d, y_2d, _ = self.cvt_3d_to_2d_with_depth(x, y, z)
+        return x_2d, y_2d
+
+    def cvt_3d_to_2d_with_depth(self, x: float, y: float, z: float) -> Tuple[int, int, float]:
+        """
+        3D座標を2D座標に変換し、カメラ座標系での奥行きも返す
+        
+        :param x: 3D空間のx座標
+        :param y: 3D空間のy座標
+        :param z: 3D空間のz座標
+        :return: 2D画像上の(x, y)座標と奥行き（奥行きが正ならカメラの前方）
+        """
+        # 1点ごとにndarrayを作らず、投影行列 K[R|t] の要素でスカラー演算する
+        row_x, row_y, (p20, p21, p22, p23) = self._p
+        # 奥行きだけを先に求め、カメラの後方の点は残りの行を計算せずに返す
+        z_c = p20 * x + p21 * y + p22 * z + p23
+        if z_c < self._MIN_DEPTH:
+            return self._OFFSCREEN + (z_c,)
+        p00, p01, p02, p03 = row_x
+        p10, p11, p12, p13 = row_y
+        # 除算は1回だけ行い、以降は逆数の乗算にする
+        inv_z = 1.0 / z_c
+        x_2d = (p00 * x + p01 * y + p02 * z + p03) * inv_z + self._cx
+        y_2d = (p10 * x + p11 * y + p12 * z + p13) * inv_z + self._cy
+        # 奥行きが0に近い点は非常に大きな座標になるため、一括変換と同じく int32 で表せる範囲に収める
+        limit = self._COORD_LIMIT
+        x_2d = -limit if x_2d < -limit else limit if x_2d > limit else x_2d
+        y_2d = -limit if y_2d < -limit else limit if y_2d > limit else y_2d
+        return int(x_2d), int(y_2d), z_c
+
+    def is_sphere_visible(self, x: float, y: float, z: float, radius: float, width: int, height: int) -> bool:
+        """
+        球が画像に写る可能性があるかどうかを判定する
+
+        ニアクリップ面と画像の上下左右の端を通る平面のいずれかに対して、球全体が外側にあれば写らない。
+        投影はしないため、カメラの後方にある場合も含めて1点の内積だけで判定できる
+        
+        :param x: 球の中心のx座標
+        :param y: 球の中心のy座標
+        :param z: 球の中心のz座標
+        :param radius: 球の半径
+        :param width: 画像の幅
+        :param height: 画像の高さ
+        :return: 球の一部でも写る可能性があればTrue
+        """
+        row_x, row_y, row_z = self._p
+        # 同次座標 (u*w, v*w, w)。u*w = fx*x_c, v*w = fy*y_c, w = z_c
+        u = row_x[0] * x + row_x[1] * y + row_x[2] * z + row_x[3]
+        v = row_y[0] * x + row_y[1] * y + row_y[2] * z + row_y[3]
+        w = row_z[0] * x + row_z[1] * y + row_z[2] * z + row_z[3]
+        if w - self._NEAR < -radius:
+            return False
+        # 画像の端 u = -m, u = width + m を通る平面はカメラ座標系で fx*x_c + (cx + m)*z_c = 0 などと表せる
+        # 法線の長さで割って、中心から平面までの符号付き距離にする
+        m = self._CULL_MARGIN
+        left, right = self._cx + m, width - self._cx + m
+        top, bottom = self._cy + m, height - self._cy + m
+        return not (
+            u + left * w < -radius * math.hypot(self._fx, left)
+            or right * w - u < -radius * math.hypot(self._fx, right)
+            or v + top * w < -radius * math.hypot(self._fy, top)
+            or bottom * w - v < -radius * math.hypot(self._fy, bottom)
+        )
+
+    def cvt_3d_to_2d_batch(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        複数の3D座標をまとめて2D座標に変換する
+        
+        :param points: 3D空間の座標列 (N, 3)
+        :return: 2D画像上の座標 (N, 2) int32（カメラの後方の点は画面外の座標） と カメラ座標系の奥行き (N,)
+        """
+        points_h = self._to_homogeneous(points)
+        return self._from_homogeneous(points_h), points_h[:, 2]
+
+    def cvt_lines_3d_to_2d(self, starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        複数の3D線分をまとめて2D座標に変換する
+
+        カメラの後方にはみ出した線分はニアクリップ面で切り取り、全体が後方にある線分は描画不可とする
+        
+        :param starts: 線分の始点 (N, 3)
+        :param ends: 線分の終点 (N, 3)
+        :return: 2D画像上の線分 (N, 2, 2) int32 と 描画可能かどうか (N,) bool
+        """
+        # 始点と終点を1回の行列積で同次座標にする
+        return self._clip_lines_homogeneous(self._to_homogeneous(np.concatenate([starts, ends])))
+
+    def cvt_edges_3d_to_2d(self, vertices: np.ndarray, edges: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        頂点を共有する複数の辺をまとめて2D座標に変換する
+
+        頂点ごとに1回だけ投影してから辺の両端を取り出すため、辺ごとに端点を投影するより計算が少ない。
+        切り取りの扱いは cvt_lines_3d_to_2d と同じ
+        
+        :param vertices: 3D空間の頂点座標 (M, 3)
+        :param edges: 辺の両端の頂点番号 (N, 2)
+        :return: 2D画像上の線分 (N, 2, 2) int32 と 描画可能かどうか (N,) bool
+        """
+        vertices_h = self._to_homogeneous(vertices)
+        # 全辺の始点、続いて全辺の終点の順に並べる
+        return self._clip_lines_homogeneous(vertices_h[np.asarray(edges).T.ravel()])
+
+    def _clip_lines_homogeneous(self, points_h: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        同次座標の線分をニアクリップ面で切り取ってから透視除算する
+        
+        :param points_h: 全線分の始点、続いて全線分の終点を並べた同次座標 (2N, 3)。内容は書き換えられる
+        :return: 2D画像上の線分 (N, 2, 2) int32 と 描画可能かどうか (N,) bool
+        """
+        n = len(points_h) // 2
+        starts_h, ends_h = points_h[:n], points_h[n:]
+        starts_behind = starts_h[:, 2] < self._NEAR
+        ends_behind = ends_h[:, 2] < self._NEAR
+        visible = ~(starts_behind & ends_behind)
+
+        # 片方の端点だけが後方にある線分は、その端点を奥行きが _NEAR になる位置まで移動する
+        # 投影は同次座標で線形なので、ワールド座標に戻さず同次座標のまま補間すればよい
+        clip = np.flatnonzero(visible & (starts_behind | ends_behind))
+        if len(clip):
+            clip_starts, clip_ends = starts_h[clip], ends_h[clip]
+            ratio = (self._NEAR - clip_starts[:, 2]) / (clip_ends[:, 2] - clip_starts[:, 2])
+            clipped = clip_starts + ratio[:, np.newaxis] * (clip_ends - clip_starts)
+            clip_start = starts_behind[clip]
+            starts_h[clip[clip_start]] = clipped[clip_start]
+            ends_h[clip[~clip_start]] = clipped[~clip_start]
+
+        lines = self._from_homogeneous(points_h).reshape(2, n, 2).swapaxes(0, 1)
+        return lines, visible
+
+    def _to_homogeneous(self, points: np.ndarray) -> np.ndarray:
+        """
+        3D座標に投影行列 K[R|t] を掛けて同次座標 (u*w, v*w, w) を求める
+        
+        K の3行目は (0, 0, 1) なので、w はカメラ座標系の奥行きそのものになる
+        
+        :param points: 3D空間の座標列 (N, 3)
+        :return: 同次座標 (N, 3)
+        """
+        # 1回の行列積と、一時配列を作らないインプレース加算で計算する
+        points_h = np.asarray(points, dtype=np.float64) @ self._P_T
+        points_h += self._P_t
+        return points_h
+
+    def _from_homogeneous(self, points_h: np.ndarray) -> np.ndarray:
+        """
+        同次座標を透視除算して2D画像上の座標にする
+        
+        :param points_h: 同次座標 (N, 3)
+        :return: 2D画像上の座標 (N, 2) int32（カメラの後方の点は画面外の座標）
         """
-        point_3d = np.array([x, y, z])
-        point_camera = self._R @ point_3d + self._t
-        x_2d = self._fx * point_camera[0] / point_camera[2] + self._cx
-        y_2d = self._fy * point_camera[1] / point_camera[2] + self._cy
-        return int(x_2d), int(y_2d)
\ No newline at end of file
+        depth = points_h[:, 2]
+        valid = depth >= self._MIN_DEPTH
+        # 透視除算の結果は int32 に変換して返すため、作業用の配列は毎回確保せず使い回す
+        if len(self._buffer) < len(depth):
+            self._buffer = np.empty((len(depth), 2))
+        points_2d = self._buffer[:len(depth)]
+        np.divide(points_h[:, :2], depth[:, np.newaxis], out=points_2d, where=valid[:, np.newaxis])
+        points_2d += (self._cx, self._cy)
+        points_2d[~valid] = self._OFFSCREEN
+        # ニアクリップ面付近の点は非常に大きな座標になるため、int32 で表せる範囲に一括で収める
+        np.clip(points_2d, -self._COORD_LIMIT, self._COORD_LIMIT, out=points_2d)
+        return points_2d.astype(np.int32)
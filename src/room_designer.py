@@ -1,9 +1,22 @@
+import math
 import numpy as np
 import cv2
 from abc import ABC, abstractmethod
 from typing import List, Tuple
 from calc3Dto2D import Tranceform3D2D
 
+# 直方体の8頂点を単位立方体の座標で表したもの（下面4点、上面4点の順）
+_BOX_CORNERS = np.array([
+    (0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0),
+    (0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1),
+], dtype=np.float64)
+# 直方体の12本の辺（_BOX_CORNERS の頂点番号の組）
+_BOX_EDGES = np.array([
+    (0, 1), (1, 2), (2, 3), (3, 0),
+    (4, 5), (5, 6), (6, 7), (7, 4),
+    (0, 4), (1, 5), (2, 6), (3, 7)
+])
+
 class Drawable(ABC):
     """描画可能なオブジェクトの抽象基底クラス"""
     
@@ -37,37 +50,44 @@ class Furniture(Drawable):
         self.x, self.y, self.z = x, y, z
         self.width, self.height, self.depth = width, height, depth
         self.color = color
+        self._geometry_key = None
+        self._vertices = None
+        self._label_anchor = None
+        self._center = None
+        self._radius = None
 
-    def get_vertices(self) -> List[Tuple[float, float, float]]:
-        """家具の頂点座標を取得する"""
-        return [
-            (self.x, self.y, self.z),
-            (self.x + self.width, self.y, self.z),
-            (self.x + self.width, self.y + self.depth, self.z),
-            (self.x, self.y + self.depth, self.z),
-            (self.x, self.y, self.z + self.height),
-            (self.x + self.width, self.y, self.z + self.height),
-            (self.x + self.width, self.y + self.depth, self.z + self.height),
-            (self.x, self.y + self.depth, self.z + self.height),
-        ]
+    def _update_geometry(self):
+        """位置と大きさが変わっていれば、頂点座標と名前の表示位置を計算し直す"""
+        key = (self.x, self.y, self.z, self.width, self.height, self.depth)
+        if key != self._geometry_key:
+            # 呼び出し元と共有するキャッシュなので書き込み不可にする（以前に返した配列は書き換えない）
+            self._vertices = _BOX_CORNERS * (self.width, self.depth, self.height) + (self.x, self.y, self.z)
+            self._vertices.setflags(write=False)
+            self._label_anchor = (self.x + self.width/2, self.y + self.depth/2, self.z + self.height)
+            # 直方体を囲む球（視野外の判定に使う）
+            self._center = (self.x + self.width/2, self.y + self.depth/2, self.z + self.height/2)
+            self._radius = 0.5 * math.sqrt(self.width**2 + self.depth**2 + self.height**2)
+            self._geometry_key = key
+
+    def get_vertices(self) -> np.ndarray:
+        """家具の頂点座標を (8, 3) の配列として取得する（内部の配列を共有するため書き込み不可）"""
+        self._update_geometry()
+        return self._vertices
 
     def draw(self, img: np.ndarray, transform: Tranceform3D2D):
         """家具を画像に描画する"""
         vertices = self.get_vertices()
-        edges = [
-            (0, 1), (1, 2), (2, 3), (3, 0),
-            (4, 5), (5, 6), (6, 7), (7, 4),
-            (0, 4), (1, 5), (2, 6), (3, 7)
-        ]
-        
-        for edge in edges:
-            start = transform.cvt_3d_to_2d(*vertices[edge[0]])
-            end = transform.cvt_3d_to_2d(*vertices[edge[1]])
-            cv2.line(img, start, end, self.color, 2)
 
-        # 家具の名前を表示
-        center = transform.cvt_3d_to_2d(self.x + self.width/2, self.y + self.depth/2, self.z + self.height)
-        cv2.putText(img, self.name, center, cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+        # 囲む球が視野の外にあれば、辺の投影と描画を省く
+        if transform.is_sphere_visible(*self._center, self._radius, img.shape[1], img.shape[0]):
+            # 8頂点をまとめて投影して12本の辺を取り出し、カメラの前方に残る線分を1回の描画呼び出しで描く
+            lines, visible = transform.cvt_edges_3d_to_2d(vertices, _BOX_EDGES)
+            cv2.polylines(img, lines[visible], False, self.color, 2)
+
+        # 家具の名前を表示（カメラの後方にある場合は表示しない）
+        center_x, center_y, depth = transform.cvt_3d_to_2d_with_depth(*self._label_anchor)
+        if depth > 0:
+            cv2.putText(img, self.name, (center_x, center_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
 
 class Room:
     """部屋クラス"""
@@ -84,27 +104,35 @@ class Room:
         self.depth = depth
         self.height = height
         self.furnitures: List[Furniture] = []
+        self._geometry_key = None
+        self._vertices = None
+        self._center = None
+        self._radius = None
 
     def add_furniture(self, furniture: Furniture):
         """家具を部屋に追加する"""
         self.furnitures.append(furniture)
 
+    def get_vertices(self) -> np.ndarray:
+        """部屋の頂点座標を (8, 3) の配列として取得する（大きさが変わったときだけ計算し直し、キャッシュを共有するため書き込み不可）"""
+        key = (self.width, self.depth, self.height)
+        if key != self._geometry_key:
+            self._vertices = _BOX_CORNERS * key
+            self._vertices.setflags(write=False)
+            # 部屋を囲む球（視野外の判定に使う）
+            self._center = (self.width/2, self.depth/2, self.height/2)
+            self._radius = 0.5 * math.sqrt(self.width**2 + self.depth**2 + self.height**2)
+            self._geometry_key = key
+        return self._vertices
+
     def draw(self, img: np.ndarray, transform: Tranceform3D2D):
         """部屋と家具を画像に描画する"""
-        # 部屋の輪郭を描画
-        vertices = [
-            (0, 0, 0), (self.width, 0, 0), (self.width, self.depth, 0), (0, self.depth, 0),
-            (0, 0, self.height), (self.width, 0, self.height), (self.width, self.depth, self.height), (0, self.depth, self.height)
-        ]
-        edges = [
-            (0, 1), (1, 2), (2, 3), (3, 0),
-            (4, 5), (5, 6), (6, 7), (7, 4),
-            (0, 4), (1, 5), (2, 6), (3, 7)
-        ]
-        for edge in edges:
-            start = transform.cvt_3d_to_2d(*vertices[edge[0]])
-            end = transform.cvt_3d_to_2d(*vertices[edge[1]])
-            cv2.line(img, start, end, (128, 128, 128), 1)
+        # 部屋の輪郭を描画（8頂点は1回ずつ投影し、辺ごとに投影し直さない）
+        vertices = self.get_vertices()
+        # 部屋全体が視野の外にあれば輪郭の投影を省く（家具は部屋の外に置かれることもあるため個別に判定する）
+        if transform.is_sphere_visible(*self._center, self._radius, img.shape[1], img.shape[0]):
+            lines, visible = transform.cvt_edges_3d_to_2d(vertices, _BOX_EDGES)
+            cv2.polylines(img, lines[visible], False, (128, 128, 128), 1)
 
         # 家具を描画
         for furniture in self.furnitures:
@@ -136,6 +164,19 @@ class RoomDesigner:
         self.room = Room(500, 500, 250)
         self._add_sample_furnitures()
 
+        # キーごとのカメラ操作（キー入力のたびに比較を繰り返さないよう辞書で引く）
+        self._key_handlers = {
+            ord('w'): self._move_forward,
+            ord('s'): self._move_backward,
+            ord('a'): self._move_left,
+            ord('d'): self._move_right,
+            ord('q'): self._tilt_up,
+            ord('e'): self._tilt_down,
+            ord('r'): self._move_up,
+            ord('f'): self._move_down,
+        }
+        self._build_instructions_sprite()
+
     def _add_sample_furnitures(self):
         """サンプルの家具を追加する"""
         self.room.add_furniture(Furniture("テーブル", 150, 200, 0, 150, 75, 100, (0, 255, 0)))
@@ -148,27 +189,52 @@ class RoomDesigner:
         """メインループ"""
         cv2.namedWindow("3D Room Designer")
 
+        # 描画バッファは1回だけ確保し、毎フレーム0で塗りつぶして再利用する
+        img = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        last_scene_key = None
+
         while True:
-            img = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+            # カメラも部屋も変わっていなければ、前回表示した画像をそのまま使い描画を省く
+            scene_key = self._scene_key()
+            if scene_key != last_scene_key:
+                img.fill(0)
 
-            # カメラの位置と角度を設定
-            self.transform.set_external_parameter(0, self.camera_pitch, 0, self.camera_x, self.camera_y, self.camera_z)
+                # カメラの位置と角度を設定
+                self.transform.set_external_parameter(0, self.camera_pitch, 0, self.camera_x, self.camera_y, self.camera_z)
 
-            # 部屋と家具を描画
-            self.room.draw(img, self.transform)
+                # 部屋と家具を描画
+                self.room.draw(img, self.transform)
 
-            # 操作説明を表示
-            self._draw_instructions(img)
+                # 操作説明を表示
+                self._draw_instructions(img)
 
-            cv2.imshow("3D Room Designer", img)
+                cv2.imshow("3D Room Designer", img)
+                last_scene_key = scene_key
 
             if self._handle_input():
                 break
 
         cv2.destroyAllWindows()
 
-    def _draw_instructions(self, img: np.ndarray):
-        """操作説明を画像に描画する"""
+    def _scene_key(self) -> tuple:
+        """
+        描画結果に影響する値をまとめる（前回のフレームと比べて再描画が必要か判定するため）
+        
+        :return: カメラの位置と角度、部屋の大きさ、各家具の位置・大きさ・名前・色
+        """
+        room = self.room
+        return (
+            (self.camera_x, self.camera_y, self.camera_z, self.camera_pitch),
+            (room.width, room.depth, room.height),
+            tuple((f.x, f.y, f.z, f.width, f.height, f.depth, f.name, tuple(f.color)) for f in room.furnitures),
+        )
+
+    def _build_instructions_sprite(self):
+        """
+        操作説明の文字列は変わらないため、一度だけ描画した画像を保持しておく
+        
+        ウィンドウと同じ大きさの黒画像に描いてから文字を含む範囲だけを切り出す
+        """
         instructions = [
             "W/S: Move Forward/Backward",
             "A/D: Move Left/Right",
@@ -176,8 +242,23 @@ class RoomDesigner:
             "R/F: Move Up/Down",
             "Esc: Quit"
         ]
+        canvas = np.zeros((self.height, self.width, 3), dtype=np.uint8)
         for i, instruction in enumerate(instructions):
-            cv2.putText(img, instruction, (10, 30 + i*30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+            cv2.putText(canvas, instruction, (10, 30 + i*30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+        mask = canvas.any(axis=2)
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0:
+            self._instructions_roi = (slice(0, 0), slice(0, 0))
+        else:
+            self._instructions_roi = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        self._instructions_sprite = canvas[self._instructions_roi].copy()
+
+    def _draw_instructions(self, img: np.ndarray):
+        """操作説明を画像に描画する"""
+        # 毎フレーム文字を描き直さず、描画済みの文字を重ねる
+        # 白い文字を黒地に描いたものなので、画素ごとの最大値をとれば下の線を消さずに重ねられる
+        roi = img[self._instructions_roi]
+        cv2.max(roi, self._instructions_sprite, dst=roi)
 
     def _handle_input(self) -> bool:
         """
@@ -188,24 +269,43 @@ class RoomDesigner:
         key = cv2.waitKey(1) & 0xFF
         if key == 27:  # Esc key
             return True
-        elif key == ord('w'):
-            self.camera_y += 10
-        elif key == ord('s'):
-            self.camera_y -= 10
-        elif key == ord('a'):
-            self.camera_x -= 10
-        elif key == ord('d'):
-            self.camera_x += 10
-        elif key == ord('q'):
-            self.camera_pitch = min(self.camera_pitch + 5, 89)
-        elif key == ord('e'):
-            self.camera_pitch = max(self.camera_pitch - 5, -89)
-        elif key == ord('r'):
-            self.camera_z += 10
-        elif key == ord('f'):
-            self.camera_z = max(self.camera_z - 10, 10)
+        handler = self._key_handlers.get(key)
+        if handler:
+            handler()
         return False
 
+    def _move_forward(self):
+        """カメラを前に移動する"""
+        self.camera_y += 10
+
+    def _move_backward(self):
+        """カメラを後ろに移動する"""
+        self.camera_y -= 10
+
+    def _move_left(self):
+        """カメラを左に移動する"""
+        self.camera_x -= 10
+
+    def _move_right(self):
+        """カメラを右に移動する"""
+        self.camera_x += 10
+
+    def _tilt_up(self):
+        """カメラのピッチ角を上げる"""
+        self.camera_pitch = min(self.camera_pitch + 5, 89)
+
+    def _tilt_down(self):
+        """カメラのピッチ角を下げる"""
+        self.camera_pitch = max(self.camera_pitch - 5, -89)
+
+    def _move_up(self):
+        """カメラを上に移動する"""
+        self.camera_z += 10
+
+    def _move_down(self):
+        """カメラを下に移動する（床より下には行かない）"""
+        self.camera_z = max(self.camera_z - 10, 10)
+
 if __name__ == "__main__":
     designer = RoomDesigner(1280, 720)
     designer.run()
\ No newline at end of file